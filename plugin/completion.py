@@ -1,30 +1,34 @@
 from .core.edit import parse_text_edit
 from .core.logging import debug
+from .core.logging import exception_log
 from .core.promise import Promise
 from .core.protocol import CompletionItem
-from .core.protocol import CompletionItemKind
 from .core.protocol import CompletionList
 from .core.protocol import CompletionParams
 from .core.protocol import Error
 from .core.protocol import InsertReplaceEdit
 from .core.protocol import InsertTextFormat
 from .core.protocol import MarkupContent, MarkedString, MarkupKind
+from .core.protocol import Position
 from .core.protocol import Range
 from .core.protocol import Request
 from .core.protocol import TextEdit
 from .core.registry import LspTextCommand
 from .core.sessions import Session
 from .core.settings import userprefs
-from .core.typing import Callable, List, Dict, Optional, Generator, Tuple, Union, cast
-from .core.views import format_completion
+from .core.typing import Any, Callable, List, Dict, Optional, Generator, Set, Tuple, Union, cast
+from .core.views import format_completion_batch
 from .core.views import FORMAT_STRING, FORMAT_MARKUP_CONTENT
 from .core.views import MarkdownLangMap
 from .core.views import minihtml
+from .core.views import position
 from .core.views import range_to_region
 from .core.views import show_lsp_popup
 from .core.views import text_document_position_params
 from .core.views import update_lsp_popup
-import functools
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from weakref import WeakValueDictionary
 import sublime
 import weakref
 import webbrowser
@@ -32,17 +36,66 @@ import webbrowser
 SessionName = str
 CompletionResponse = Union[List[CompletionItem], CompletionList, None]
 ResolvedCompletions = Tuple[Union[CompletionResponse, Error], 'weakref.ref[Session]']
+# The session name, whether the session can resolve items, whether the response is incomplete, and the response items
+CompletionItemsOfSession = Tuple[SessionName, bool, bool, List[CompletionItem]]
+# Maps a session name to the word start location, the prefix, the position of the request and the items of its last
+# complete response
+CompletionsCache = Dict[SessionName, Tuple[int, str, Position, List[CompletionItem]]]
+
+# Strips carriage returns from inserted completion text
+_CR_TABLE = str.maketrans('', '', '\r')
 
 
 def get_text_edit_range(text_edit: Union[TextEdit, InsertReplaceEdit]) -> Range:
-    if 'insert' in text_edit and 'replace' in text_edit:
-        text_edit = cast(InsertReplaceEdit, text_edit)
-        insert_mode = userprefs().completion_insert_mode
-        if LspCommitCompletionWithOppositeInsertMode.active:
-            insert_mode = 'replace' if insert_mode == 'insert' else 'insert'
-        return text_edit.get(insert_mode)  # type: ignore
-    text_edit = cast(TextEdit, text_edit)
-    return text_edit['range']
+    # Most servers send a plain TextEdit, so check for that first.
+    text_edit_range = cast(TextEdit, text_edit).get('range')
+    if text_edit_range is not None:
+        return text_edit_range
+    text_edit = cast(InsertReplaceEdit, text_edit)
+    insert_mode = userprefs().completion_insert_mode
+    if LspCommitCompletionWithOppositeInsertMode.active:
+        insert_mode = 'replace' if insert_mode == 'insert' else 'insert'
+    return text_edit.get(insert_mode)  # type: ignore
+
+
+class StoredCompletionItems:
+    """
+    Wraps the items of a completion response so that they can be referenced weakly.
+    """
+    __slots__ = ('items', '__weakref__')
+
+    def __init__(self, items: List[CompletionItem]) -> None:
+        self.items = items
+
+
+def _shift_text_edit_end(item: CompletionItem, request_position: Position, delta: int) -> CompletionItem:
+    """
+    Return the item with the ends of its text edit ranges at or after `request_position` moved by `delta` characters.
+    The original item is left untouched as it's still referenced by the completions cache.
+    """
+    text_edit = item.get('textEdit')
+    if not text_edit or not delta:
+        return item
+    shifted_text_edit = dict(text_edit)  # type: Dict[str, Any]
+    for key in ('range', 'insert', 'replace'):
+        edit_range = shifted_text_edit.get(key)
+        if not edit_range:
+            continue
+        end = edit_range['end']
+        if end['line'] == request_position['line'] and end['character'] >= request_position['character']:
+            shifted_text_edit[key] = {
+                'start': edit_range['start'],
+                'end': {'line': end['line'], 'character': end['character'] + delta}
+            }
+    shifted_item = dict(item)  # type: Dict[str, Any]
+    shifted_item['textEdit'] = shifted_text_edit
+    return cast(CompletionItem, shifted_item)
+
+
+def _completion_sort_key(item: CompletionItem) -> str:
+    # Servers almost always send a sortText, so that's the fast path.
+    sort_text = item.get("sortText")
+    return sort_text if sort_text is not None else item.get("label", "")
 
 
 class QueryCompletionsTask:
@@ -52,46 +105,150 @@ class QueryCompletionsTask:
     Can be canceled while in progress in which case the "on_done_async" callback will get immediately called with empty
     list and the pending response from the server(s) will be canceled and results ignored.
 
+    When multiple sessions are queried, the responses are merged as they arrive. If the
+    "completion_slow_server_timeout_ms" setting is enabled, sessions that haven't responded within that time after the
+    first server response with items get their requests canceled.
+
+    Responses that are not marked as incomplete are stored in the given cache. As long as the user keeps typing the same
+    word, subsequent tasks reuse the cached items instead of sending a new request to that server. Sublime filters them
+    as usual.
+
     All public methods must only be called on the async thread and the "on_done_async" callback will also be called
     on the async thread.
     """
+
+    _pool = None  # type: Optional[ThreadPoolExecutor]
+
     def __init__(
         self,
         view: sublime.View,
         location: int,
+        prefix: str,
         triggered_manually: bool,
-        on_done_async: Callable[[List[sublime.CompletionItem], int], None]
+        on_done_async: Callable[[List[sublime.CompletionItem], int], None],
+        cache: CompletionsCache
     ) -> None:
         self._view = view
         self._location = location
+        self._prefix = prefix
+        self._word_start = location - len(prefix)
+        self._position = position(view, location)
+        self._cache = cache
+        self._cached_session_names = set()  # type: Set[SessionName]
         self._triggered_manually = triggered_manually
         self._on_done_async = on_done_async
         self._resolved = False
-        self._pending_completion_requests = {}  # type: Dict[int, weakref.ref[Session]]
+        self._responses_merged = False
+        self._slow_responses_timeout_started = False
+        self.stored_completion_items = []  # type: List[StoredCompletionItems]
+        self._pending_completion_requests = WeakValueDictionary()  # type: WeakValueDictionary[int, Session]
+
+    @classmethod
+    def shutdown(cls) -> None:
+        if cls._pool:
+            cls._pool.shutdown(wait=False)
+            cls._pool = None
+
+    @classmethod
+    def _get_pool(cls) -> ThreadPoolExecutor:
+        # Created lazily, so that it's available again when the plugin gets loaded after a shutdown.
+        if cls._pool is None:
+            cls._pool = ThreadPoolExecutor(max_workers=2)
+        return cls._pool
 
     def query_completions_async(self, sessions: List[Session]) -> None:
-        promises = [self._create_completion_request_async(session) for session in sessions]
-        Promise.all(promises).then(lambda response: self._resolve_completions_async(response))
-
-    def _create_completion_request_async(self, session: Session) -> Promise[ResolvedCompletions]:
         params = cast(CompletionParams, text_document_position_params(self._view, self._location))
-        request = Request.complete(params, self._view)
+        promises = []  # type: List[Promise[ResolvedCompletions]]
+        for session in sessions:
+            cached_items = self._get_cached_completions(session.config.name)
+            if cached_items is None:
+                promises.append(self._create_completion_request_async(session, params))
+            else:
+                self._cached_session_names.add(session.config.name)
+                promises.append(Promise.resolve((cached_items, weakref.ref(session))))
+        if len(promises) == 1 or userprefs().completion_slow_server_timeout_ms <= 0:
+            Promise.all(promises).then(lambda response: self._resolve_completions_async(response))
+            return
+        responses = []  # type: List[ResolvedCompletions]
+        for promise in promises:
+            promise.then(lambda response: self._merge_partial_response_async(response, responses, len(promises)))
+
+    def _merge_partial_response_async(
+        self, response: ResolvedCompletions, responses: List[ResolvedCompletions], expected_count: int
+    ) -> None:
+        if self._resolved or self._responses_merged:
+            return
+        responses.append(response)
+        if len(responses) == expected_count:
+            self._responses_merged = True
+            self._resolve_completions_async(responses)
+        elif not self._slow_responses_timeout_started and self._is_server_response_with_items(response):
+            # Sublime's completion widget can't be extended after it's shown, so don't let the slowest server hold
+            # back the results of the others for too long.
+            self._slow_responses_timeout_started = True
+            sublime.set_timeout_async(
+                lambda: self._on_slow_responses_timeout_async(responses),
+                userprefs().completion_slow_server_timeout_ms)
+
+    def _is_server_response_with_items(self, response: ResolvedCompletions) -> bool:
+        result, weak_session = response
+        if not result or isinstance(result, Error):
+            return False
+        session = weak_session()
+        if not session or session.config.name in self._cached_session_names:
+            return False
+        return bool(result.get("items") if isinstance(result, dict) else result)
+
+    def _on_slow_responses_timeout_async(self, responses: List[ResolvedCompletions]) -> None:
+        if self._resolved or self._responses_merged:
+            return
+        debug("completion responses of {} session(s) took too long and are ignored".format(
+            len(self._pending_completion_requests)))
+        self._responses_merged = True
+        self._cancel_pending_requests_async()
+        self._resolve_completions_async(list(responses))
+
+    def _create_completion_request_async(
+        self, session: Session, params: CompletionParams
+    ) -> Promise[ResolvedCompletions]:
+        # Plugins may modify the params of a request in "on_pre_send_request_async", so each session gets a copy.
+        session_params = cast(CompletionParams, {
+            "textDocument": dict(params["textDocument"]),
+            "position": dict(params["position"])
+        })
+        request = Request.complete(session_params, self._view)
         promise, request_id = session.send_request_task_2(request)
         weak_session = weakref.ref(session)
-        self._pending_completion_requests[request_id] = weak_session
+        self._pending_completion_requests[request_id] = session
         return promise.then(lambda response: self._on_completion_response_async(response, request_id, weak_session))
 
+    def _get_cached_completions(self, session_name: SessionName) -> Optional[List[CompletionItem]]:
+        if self._triggered_manually or not self._prefix:
+            return None
+        cached = self._cache.get(session_name)
+        if not cached:
+            return None
+        word_start, prefix, cached_position, items = cached
+        if word_start != self._word_start or not self._prefix.startswith(prefix) or \
+                cached_position['line'] != self._position['line']:
+            return None
+        # Sublime filters the items itself, but the text edits must account for the characters typed since then.
+        delta = self._position['character'] - cached_position['character']
+        return [_shift_text_edit_end(item, cached_position, delta) for item in items]
+
     def _on_completion_response_async(
         self, response: CompletionResponse, request_id: int, weak_session: 'weakref.ref[Session]'
     ) -> ResolvedCompletions:
         self._pending_completion_requests.pop(request_id, None)
+        if self._resolved:
+            # The task got canceled in the meantime, so don't hold on to a potentially large response.
+            return (None, weak_session)
         return (response, weak_session)
 
     def _resolve_completions_async(self, responses: List[ResolvedCompletions]) -> None:
         if self._resolved:
             return
-        LspResolveDocsCommand.completions = {}
-        items = []  # type: List[sublime.CompletionItem]
+        completion_lists = []  # type: List[CompletionItemsOfSession]
         errors = []  # type: List[Error]
         flags = 0  # int
         prefs = userprefs()
@@ -110,25 +267,72 @@ class QueryCompletionsTask:
             if not session:
                 continue
             response_items = []  # type: List[CompletionItem]
+            is_incomplete = False
             if isinstance(response, dict):
                 response_items = response["items"] or []
-                if response.get("isIncomplete", False):
+                is_incomplete = response.get("isIncomplete", False)
+                if is_incomplete:
                     flags |= sublime.DYNAMIC_COMPLETIONS
             elif isinstance(response, list):
                 response_items = response
-            response_items = sorted(response_items, key=lambda item: item.get("sortText") or item["label"])
-            LspResolveDocsCommand.completions[session.config.name] = response_items
             can_resolve_completion_items = session.has_capability('completionProvider.resolveProvider')
-            config_name = session.config.name
-            items.extend(
-                format_completion(response_item, index, can_resolve_completion_items, config_name, self._view.id())
-                for index, response_item in enumerate(response_items)
-                if include_snippets or response_item.get("kind") != CompletionItemKind.Snippet)
-        if items:
-            flags |= sublime.INHIBIT_REORDER
+            completion_lists.append((session.config.name, can_resolve_completion_items, is_incomplete, response_items))
         if errors:
             error_messages = ", ".join(str(error) for error in errors)
             sublime.status_message('Completion error: {}'.format(error_messages))
+        # Sorting and formatting can take a while for large responses, so it's done on a worker thread in order to
+        # keep the async thread responsive.
+        try:
+            future = self._get_pool().submit(
+                self._format_completions, completion_lists, bool(include_snippets), self._view.id())
+        except Exception as ex:
+            exception_log("Failed to schedule formatting of completion items", ex)
+            self._resolve_task_async([])
+            return
+        future.add_done_callback(lambda f: sublime.set_timeout_async(
+            lambda: self._on_completions_formatted_async(f, completion_lists, flags)))
+
+    def _format_completions(
+        self, completion_lists: List[CompletionItemsOfSession], include_snippets: bool, view_id: int
+    ) -> List[sublime.CompletionItem]:
+        """
+        Sort the items of each session and convert them to Sublime's completion items. Runs on a worker thread and
+        stops early when the task gets canceled.
+        """
+        items = []  # type: List[sublime.CompletionItem]
+        for config_name, can_resolve_completion_items, _, response_items in completion_lists:
+            if self._resolved:
+                # The task was canceled on the async thread in the meantime.
+                return []
+            response_items.sort(key=_completion_sort_key)
+            items.extend(format_completion_batch(
+                response_items, can_resolve_completion_items, config_name, view_id, include_snippets))
+        return items
+
+    def _on_completions_formatted_async(
+        self, future: 'Future[List[sublime.CompletionItem]]', completion_lists: List[CompletionItemsOfSession],
+        flags: int
+    ) -> None:
+        if self._resolved:
+            return
+        try:
+            items = future.result()
+        except Exception as ex:
+            exception_log("Failed to format completion items", ex)
+            self._resolve_task_async([])
+            return
+        view_id = self._view.id()
+        for config_name, _, is_incomplete, response_items in completion_lists:
+            if config_name not in self._cached_session_names:
+                if is_incomplete:
+                    self._cache.pop(config_name, None)
+                else:
+                    self._cache[config_name] = (self._word_start, self._prefix, self._position, response_items)
+            stored_items = StoredCompletionItems(response_items)
+            LspResolveDocsCommand.completions[(view_id, config_name)] = stored_items
+            self.stored_completion_items.append(stored_items)
+        if items:
+            flags |= sublime.INHIBIT_REORDER
         self._resolve_task_async(items, flags)
 
     def cancel_async(self) -> None:
@@ -136,10 +340,8 @@ class QueryCompletionsTask:
         self._cancel_pending_requests_async()
 
     def _cancel_pending_requests_async(self) -> None:
-        for request_id, weak_session in self._pending_completion_requests.items():
-            session = weak_session()
-            if session:
-                session.cancel_request(request_id, False)
+        for request_id, session in list(self._pending_completion_requests.items()):
+            session.cancel_request(request_id, False)
         self._pending_completion_requests.clear()
 
     def _resolve_task_async(self, completions: List[sublime.CompletionItem], flags: int = 0) -> None:
@@ -150,18 +352,23 @@ class QueryCompletionsTask:
 
 class LspResolveDocsCommand(LspTextCommand):
 
-    completions = {}  # type: Dict[SessionName, List[CompletionItem]]
+    # The items of the most recent completion responses per view and session. They are kept alive by the listener of
+    # the view, so they disappear once the view is closed or a new completion response arrives.
+    completions = WeakValueDictionary()  # type: WeakValueDictionary[Tuple[int, SessionName], StoredCompletionItems]
 
     def run(self, edit: sublime.Edit, index: int, session_name: str, event: Optional[dict] = None) -> None:
 
         def run_async() -> None:
-            item = self.completions[session_name][index]
+            stored_items = self.completions.get((self.view.id(), session_name))
+            if not stored_items or index >= len(stored_items.items):
+                return
+            item = stored_items.items[index]
             session = self.session_by_name(session_name, 'completionProvider.resolveProvider')
             if session:
                 request = Request.resolveCompletionItem(item, self.view)
                 language_map = session.markdown_language_id_to_st_syntax_map()
-                handler = functools.partial(self._handle_resolve_response_async, language_map)
-                session.send_request_async(request, handler)
+                session.send_request_async(
+                    request, lambda resolved_item: self._handle_resolve_response_async(language_map, resolved_item))
             else:
                 self._handle_resolve_response_async(None, item)
 
@@ -177,11 +384,12 @@ class LspResolveDocsCommand(LspTextCommand):
             markdown = {"kind": MarkupKind.Markdown, "value": "*No documentation available.*"}  # type: MarkupContent
             # No need for a language map here
             documentation = self._format_documentation(markdown, None)
-        minihtml_content = ""
+        parts = []  # type: List[str]
         if detail:
-            minihtml_content += "<div class='highlight'>{}</div>".format(detail)
+            parts.append("<div class='highlight'>{}</div>".format(detail))
         if documentation:
-            minihtml_content += documentation
+            parts.append(documentation)
+        minihtml_content = "".join(parts)
 
         def run_main() -> None:
             if not self.view.is_valid():
@@ -222,13 +430,13 @@ class LspSelectCompletionItemCommand(LspTextCommand):
     def run(self, edit: sublime.Edit, item: CompletionItem, session_name: str) -> None:
         text_edit = item.get("textEdit")
         if text_edit:
-            new_text = text_edit["newText"].replace("\r", "")
+            new_text = text_edit["newText"].translate(_CR_TABLE)
             edit_region = range_to_region(get_text_edit_range(text_edit), self.view)
             for region in self._translated_regions(edit_region):
                 self.view.erase(edit, region)
         else:
             new_text = item.get("insertText") or item["label"]
-            new_text = new_text.replace("\r", "")
+            new_text = new_text.translate(_CR_TABLE)
         if item.get("insertTextFormat", InsertTextFormat.PlainText) == InsertTextFormat.Snippet:
             self.view.run_command("insert_snippet", {"contents": new_text})
         else:
@@ -236,15 +444,17 @@ class LspSelectCompletionItemCommand(LspTextCommand):
         # todo: this should all run from the worker thread
         session = self.session_by_name(session_name, 'completionProvider.resolveProvider')
         additional_text_edits = item.get('additionalTextEdits')
-        if session and not additional_text_edits:
+        # Servers identify the item to resolve through its "data" field. Without it there's nothing left to resolve.
+        needs_resolve = 'data' in item or bool(item.get('command'))
+        if session and needs_resolve and not additional_text_edits:
             session.send_request_async(
                 Request.resolveCompletionItem(item, self.view),
-                functools.partial(self._on_resolved_async, session_name))
+                lambda resolved_item: self._on_resolved_async(session_name, resolved_item))
         else:
             self._on_resolved(session_name, item)
 
     def _on_resolved_async(self, session_name: str, item: CompletionItem) -> None:
-        sublime.set_timeout(functools.partial(self._on_resolved, session_name, item))
+        sublime.set_timeout(lambda: self._on_resolved(session_name, item))
 
     def _on_resolved(self, session_name: str, item: CompletionItem) -> None:
         additional_edits = item.get('additionalTextEdits')
@@ -264,10 +474,10 @@ class LspSelectCompletionItemCommand(LspTextCommand):
     def _translated_regions(self, edit_region: sublime.Region) -> Generator[sublime.Region, None, None]:
         selection = self.view.sel()
         primary_cursor_position = selection[0].b
-        for region in reversed(selection):
+        a, b = edit_region.a, edit_region.b
+        for i in range(len(selection) - 1, -1, -1):
             # For each selection region, apply the same removal as for the "primary" region.
             # To do that, translate, or offset, the LSP edit region into the non-"primary" regions.
             # The concept of "primary" is our own, and there is no mention of it in the LSP spec.
-            translation = region.b - primary_cursor_position
-            translated_edit_region = sublime.Region(edit_region.a + translation, edit_region.b + translation)
-            yield translated_edit_region
+            translation = selection[i].b - primary_cursor_position
+            yield sublime.Region(a + translation, b + translation)
@@ -1168,6 +1168,7 @@ class Session(TransportCallbacks):
         self._dynamic_file_watchers = {}  # type: Dict[str, List[FileWatcher]]
         self._plugin_class = plugin_class
         self._plugin = None  # type: Optional[AbstractPlugin]
+        self._markdown_language_map = None  # type: Optional[MarkdownLangMap]
         self._status_messages = {}  # type: Dict[str, str]
         self._semantic_tokens_map = get_semantic_tokens_map(config.semantic_tokens)
 
@@ -1344,7 +1345,8 @@ class Session(TransportCallbacks):
     # --- misc methods -------------------------------------------------------------------------------------------------
 
     def markdown_language_id_to_st_syntax_map(self) -> Optional[MarkdownLangMap]:
-        return self._plugin.markdown_language_id_to_st_syntax_map() if self._plugin is not None else None
+        # Computed once when the plugin is created, as popups ask for it on every selection change.
+        return self._markdown_language_map
 
     def handles_path(self, file_path: Optional[str], inside_workspace: bool) -> bool:
         if self._supports_workspace_folders():
@@ -1399,6 +1401,7 @@ class Session(TransportCallbacks):
         self.state = ClientStates.READY
         if self._plugin_class is not None:
             self._plugin = self._plugin_class(weakref.ref(self))
+            self._markdown_language_map = self._plugin.markdown_language_id_to_st_syntax_map()
             # We've missed calling the "on_server_response_async" API as plugin was not created yet.
             # Handle it now and use fake request ID since it shouldn't matter.
             self._plugin.on_server_response_async('initialize', Response(-1, result))
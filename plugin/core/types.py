@@ -199,6 +199,8 @@ class Settings:
     inhibit_word_completions = cast(bool, None)
     link_highlight_style = cast(str, None)
     completion_insert_mode = cast(str, None)
+    completion_debounce_ms = cast(int, None)
+    completion_slow_server_timeout_ms = cast(int, None)
     log_debug = cast(bool, None)
     log_max_size = cast(int, None)
     log_server = cast(List[str], None)
@@ -245,6 +247,8 @@ class Settings:
         r("on_save_task_timeout_ms", 2000)
         r("only_show_lsp_completions", False)
         r("completion_insert_mode", 'insert')
+        r("completion_debounce_ms", 50)
+        r("completion_slow_server_timeout_ms", 0)
         r("popup_max_characters_height", 1000)
         r("popup_max_characters_width", 120)
         r("semantic_highlighting", False)
@@ -1082,6 +1082,25 @@ def format_completion(
     return completion
 
 
+def format_completion_batch(
+    items: List[CompletionItem], can_resolve_completion_items: bool, session_name: str, view_id: int,
+    include_snippets: bool
+) -> List[sublime.CompletionItem]:
+    # This is a hot function as well, it runs for every item of a completion response.
+    # The index must refer to the position in the unfiltered items, so filter while enumerating.
+    if include_snippets:
+        return [
+            format_completion(item, index, can_resolve_completion_items, session_name, view_id)
+            for index, item in enumerate(items)
+        ]
+    snippet_kind = CompletionItemKind.Snippet
+    return [
+        format_completion(item, index, can_resolve_completion_items, session_name, view_id)
+        for index, item in enumerate(items)
+        if item.get('kind') != snippet_kind
+    ]
+
+
 def format_code_actions_for_quick_panel(
     session_actions: Iterable[Tuple[str, Union[CodeAction, Command]]]
 ) -> Tuple[List[sublime.QuickPanelItem], int]:
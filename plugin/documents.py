@@ -1,7 +1,9 @@
 from .code_actions import actions_manager
 from .code_actions import CodeActionOrCommand
 from .code_actions import CodeActionsByConfigName
+from .completion import CompletionsCache
 from .completion import QueryCompletionsTask
+from .completion import StoredCompletionItems
 from .core.logging import debug
 from .core.panels import PanelName
 from .core.protocol import Diagnostic
@@ -47,7 +49,6 @@ from .core.windows import WindowManager
 from .hover import code_actions_content
 from .session_buffer import SessionBuffer
 from .session_view import SessionView
-from functools import partial
 from weakref import WeakSet
 from weakref import WeakValueDictionary
 import itertools
@@ -151,8 +152,11 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
         self._auto_complete_triggered_manually = False
         self._change_count_on_last_save = -1
         self._code_lenses_debouncer_async = DebouncerNonThreadSafe(async_thread=True)
+        self._completions_debouncer_async = DebouncerNonThreadSafe(async_thread=True)
         self._registration = SettingsRegistration(view.settings(), on_change=on_change)
         self._completions_task = None  # type: Optional[QueryCompletionsTask]
+        self._completions_cache = {}  # type: CompletionsCache
+        self._stored_completion_items = []  # type: List[StoredCompletionItems]
         self._setup()
 
     def __del__(self) -> None:
@@ -219,6 +223,7 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
             self._do_code_lenses_async()
 
     def on_session_shutdown_async(self, session: Session) -> None:
+        self._completions_cache.pop(session.config.name, None)
         removed_session = self._session_views.pop(session.config.name, None)
         if removed_session:
             removed_session.on_before_remove()
@@ -310,6 +315,10 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
         if self.view.is_primary():
             for sv in self.session_views_async():
                 sv.on_text_changed_async(change_count, changes)
+        if self._completions_cache and not all(
+                self._is_inside_cached_completions_word_async(change.a.pt, change.a.pt + len(change.str))
+                for change in changes):
+            self._completions_cache.clear()
         self._on_view_updated_async()
 
     def get_uri(self) -> DocumentUri:
@@ -352,6 +361,9 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
     def on_selection_modified_async(self) -> None:
         different, current_region = self._update_stored_region_async()
         if different:
+            if self._completions_cache and \
+                    not self._is_inside_cached_completions_word_async(current_region.b, current_region.b):
+                self._completions_cache.clear()
             if not self._is_in_higlighted_region(current_region.b):
                 self._clear_highlight_regions()
             if userprefs().document_highlight_style:
@@ -474,6 +486,9 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
         return None
 
     def on_post_text_command(self, command_name: str, args: Optional[Dict[str, Any]]) -> None:
+        if command_name in ("commit_completion", "insert_best_completion", "lsp_select_completion_item"):
+            # The completion session ended, a completion in the same word should query the servers again.
+            sublime.set_timeout_async(self._completions_cache.clear)
         if command_name in ("next_field", "prev_field") and args is None:
             sublime.set_timeout_async(lambda: self.do_signature_help_async(manual=True))
         if not self.view.is_popup_visible():
@@ -487,28 +502,60 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
         triggered_manually = self._auto_complete_triggered_manually
         self._auto_complete_triggered_manually = False  # reset state for next completion popup
         sublime.set_timeout_async(
-            lambda: self._on_query_completions_async(completion_list, locations[0], triggered_manually))
+            lambda: self._on_query_completions_async(completion_list, locations[0], prefix, triggered_manually))
         return completion_list
 
     # --- textDocument/complete ----------------------------------------------------------------------------------------
 
     def _on_query_completions_async(
-        self, clist: sublime.CompletionList, location: int, triggered_manually: bool
+        self, clist: sublime.CompletionList, location: int, prefix: str, triggered_manually: bool
     ) -> None:
         if self._completions_task:
             self._completions_task.cancel_async()
-        on_done = partial(self._on_query_completions_resolved_async, clist)
-        self._completions_task = QueryCompletionsTask(self.view, location, triggered_manually, on_done)
+        task = None  # type: Optional[QueryCompletionsTask]
+
+        def on_done(completions: List[sublime.CompletionItem], flags: int = 0) -> None:
+            assert task
+            self._on_query_completions_resolved_async(clist, task, completions, flags)
+
+        task = self._completions_task = QueryCompletionsTask(
+            self.view, location, prefix, triggered_manually, on_done, self._completions_cache)
+        if triggered_manually or self._is_completion_trigger_character_async(location):
+            self._completions_debouncer_async.cancel_pending()
+            self._do_query_completions_async(task)
+        else:
+            self._completions_debouncer_async.debounce(
+                lambda: self._do_query_completions_async(task),
+                timeout_ms=userprefs().completion_debounce_ms,
+                condition=lambda: task is self._completions_task)
+
+    def _do_query_completions_async(self, task: QueryCompletionsTask) -> None:
         sessions = list(self.sessions_async('completionProvider'))
         if not sessions or not self.view.is_valid():
-            self._completions_task.cancel_async()
+            task.cancel_async()
             return
         self.purge_changes_async()
-        self._completions_task.query_completions_async(sessions)
+        task.query_completions_async(sessions)
+
+    def _is_completion_trigger_character_async(self, location: int) -> bool:
+        for sb in self.session_buffers_async():
+            triggers = sb.get_capability("completionProvider.triggerCharacters") or []  # type: List[str]
+            for trigger in triggers:
+                if trigger and self.view.substr(sublime.Region(location - len(trigger), location)) == trigger:
+                    return True
+        return False
 
     def _on_query_completions_resolved_async(
-        self, clist: sublime.CompletionList, completions: List[sublime.CompletionItem], flags: int = 0
+        self,
+        clist: sublime.CompletionList,
+        task: QueryCompletionsTask,
+        completions: List[sublime.CompletionItem],
+        flags: int = 0
     ) -> None:
+        if task.stored_completion_items:
+            # Keep the items alive for "lsp_resolve_docs" until the next completion response. Canceled tasks don't
+            # deliver any items, so they must not drop the items of the popup that is still shown.
+            self._stored_completion_items = task.stored_completion_items
         self._completions_task = None
         # Resolve on the main thread to prevent any sort of data race for _set_target (see sublime_plugin.py).
         sublime.set_timeout(lambda: clist.set_completions(completions, flags))
@@ -792,12 +839,14 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
             sv.on_pre_save_async()
 
     def revert_async(self) -> None:
+        self._completions_cache.clear()
         if self.view.is_primary():
             for sv in self.session_views_async():
                 sv.on_revert_async()
         self._on_view_updated_async()
 
     def reload_async(self) -> None:
+        self._completions_cache.clear()
         if self.view.is_primary():
             for sv in self.session_views_async():
                 sv.on_reload_async()
@@ -850,6 +899,20 @@ class DocumentSyncListener(sublime_plugin.ViewEventListener, AbstractViewListene
                 self._do_highlights_async, current_region, after_ms=self.highlights_debounce_time)
         self.do_signature_help_async(manual=False)
 
+    def _is_inside_cached_completions_word_async(self, begin: int, end: int) -> bool:
+        """
+        Whether the given region lies within the words that the cached completions were requested for. Anything else
+        means the user moved on, so the cached completions may be stale.
+        """
+        word_separators = self.view.settings().get("word_separators") or ""
+        for word_start, _, _, _ in self._completions_cache.values():
+            if begin < word_start:
+                return False
+            text = self.view.substr(sublime.Region(word_start, end))
+            if any(char.isspace() or char in word_separators for char in text):
+                return False
+        return True
+
     def _update_stored_region_async(self) -> Tuple[bool, sublime.Region]:
         """
         Stores the current first selection in a variable.